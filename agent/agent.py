@@ -4,19 +4,40 @@ This agent specializes in helping users create travel plans, research destinatio
 brainstorm ideas, and build structured markdown documents collaboratively.
 """
 
-from typing import Any, List, Dict
+from typing import Any, List, Dict, NamedTuple, Union
 from typing_extensions import Literal
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import SystemMessage, BaseMessage
+from langchain_core.messages import SystemMessage, AIMessage, HumanMessage, ToolMessage, message_chunk_to_message, trim_messages
+from langchain_core.messages.utils import count_tokens_approximately
 from langchain_core.runnables import RunnableConfig
 from langchain.tools import tool
-from langgraph.graph import StateGraph, END
+from langgraph.graph import StateGraph
 from langgraph.types import Command
 from langgraph.graph import MessagesState
-from langgraph.prebuilt import ToolNode
-import json
+import asyncio
+import atexit
+import contextvars
+import hashlib
+import orjson
+import aiohttp
+from functools import cache, lru_cache
+from types import MappingProxyType
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import os as _os
+import logging
+import re
+import pickle
+import tempfile
+import time
+
+try:
+    # Linear-time RE2 engine for patterns run against user-supplied text; optional
+    import re2 as _re_user
+except ImportError:
+    _re_user = re
+
+logger = logging.getLogger(__name__)
 
 class AgentState(MessagesState):
     """
@@ -25,75 +46,231 @@ class AgentState(MessagesState):
     content: str = ""
     group_id: str = ""
     tools: List[Any] = []
+    summary: str = ""
+    summarized_upto: int = 0
+
+# Static checklist sections shared by every generated checklist
+_CHECKLIST_SECTIONS: tuple[Dict[str, Any], ...] = (
+    {
+        "title": "Before You Go",
+        "items": [
+            {"label": "Book flights", "checked": False},
+            {"label": "Reserve accommodation", "checked": False},
+            {"label": "Check passport validity (>6 months)", "checked": False},
+            {"label": "Apply for visa if needed", "checked": False},
+            {"label": "Get travel insurance", "checked": False},
+            {"label": "Notify bank of travel plans", "checked": False},
+            {"label": "Check vaccination requirements", "checked": False},
+        ],
+    },
+    {
+        "title": "Pack & Prepare",
+        "items": [
+            {"label": "Pack according to weather", "checked": False},
+            {"label": "Bring necessary adapters", "checked": False},
+            {"label": "Download offline maps", "checked": False},
+            {"label": "Learn basic local phrases", "checked": False},
+            {"label": "Research local customs", "checked": False},
+            {"label": "Exchange currency or get travel card", "checked": False},
+        ],
+    },
+    {
+        "title": "During Trip",
+        "items": [
+            {"label": "Check in for flights", "checked": False},
+            {"label": "Confirm accommodations", "checked": False},
+            {"label": "Keep important documents safe", "checked": False},
+            {"label": "Stay hydrated and healthy", "checked": False},
+        ],
+    },
+)
 
-def _generate_checklist(destination: str = "", context: str = "trip") -> Dict[str, Any]:
+@lru_cache(maxsize=256)
+def _generate_checklist_cached(destination: str = "", context: str = "trip") -> tuple[str, str, str]:
     """
     Build a structured checklist based on the context and destination.
-    Returns a dict with a stable JSON schema for frontend rendering.
+    Returns (markdown, json_tag, payload_json); memoized since it only depends on its args.
     """
     title = f"{context.title()} Checklist" if not destination else f"{destination.title()} {context.title()} Checklist"
-    sections: List[Dict[str, Any]] = [
-        {
-            "title": "Before You Go",
-            "items": [
-                {"label": "Book flights", "checked": False},
-                {"label": "Reserve accommodation", "checked": False},
-                {"label": "Check passport validity (>6 months)", "checked": False},
-                {"label": "Apply for visa if needed", "checked": False},
-                {"label": "Get travel insurance", "checked": False},
-                {"label": "Notify bank of travel plans", "checked": False},
-                {"label": "Check vaccination requirements", "checked": False},
-            ],
-        },
-        {
-            "title": "Pack & Prepare",
-            "items": [
-                {"label": "Pack according to weather", "checked": False},
-                {"label": "Bring necessary adapters", "checked": False},
-                {"label": "Download offline maps", "checked": False},
-                {"label": "Learn basic local phrases", "checked": False},
-                {"label": "Research local customs", "checked": False},
-                {"label": "Exchange currency or get travel card", "checked": False},
-            ],
-        },
-        {
-            "title": "During Trip",
-            "items": [
-                {"label": "Check in for flights", "checked": False},
-                {"label": "Confirm accommodations", "checked": False},
-                {"label": "Keep important documents safe", "checked": False},
-                {"label": "Stay hydrated and healthy", "checked": False},
-            ],
-        },
-    ]
-
     payload: Dict[str, Any] = {
         "type": "checklist",
         "version": 1,
         "title": title,
         "destination": destination,
         "context": context,
-        "sections": sections,
+        "sections": _CHECKLIST_SECTIONS,
     }
+    payload_json = orjson.dumps(payload).decode("utf-8")
 
     # JSON Tag for frontend parsing. Wrapped in fenced block to keep markdown clean.
-    json_tag = "```json checklist\n" + json.dumps(payload, ensure_ascii=False) + "\n```"
+    json_tag = "```json checklist\n" + payload_json + "\n```"
 
     # Also provide a plain markdown fallback for environments that don't parse the JSON tag
     md_lines: List[str] = [f"## ✅ {title}"]
-    for section in sections:
+    for section in _CHECKLIST_SECTIONS:
         md_lines.append(f"\n### {section['title']}")
         for item in section["items"]:
             md_lines.append(f"- [ ] {item['label']}")
 
     markdown = "\n".join(md_lines)
-    return {"markdown": markdown, "json_tag": json_tag, "data": payload}
+    return markdown, json_tag, payload_json
+
+class Activity(NamedTuple):
+    """
+    A single itinerary activity, either fetched from OpenTripMap or from the fallback catalog.
+    """
+    name: str
+    description: str
+    category: str
+
+# Process-wide OpenTripMap caches: {key: (expires_at, value)}, persisted to disk between runs.
+# Keys come from user input, so each cache is capped and expired entries are pruned on write.
+_OTM_CACHE_TTL_SECONDS = 24 * 60 * 60
+_OTM_CACHE_MAX_ENTRIES = 512
+_OTM_CACHE_FILE = _os.path.expanduser("~/.frizzle/cache/otm.pkl")
+_GEO_CACHE: Dict[str, tuple[float, tuple[float, float]]] = {}
+_ACTIVITIES_CACHE: Dict[tuple[str, str, int], tuple[float, tuple[Activity, ...]]] = {}
+# Fetches currently running per _ACTIVITIES_CACHE key
+_ACTIVITIES_IN_FLIGHT: Dict[tuple[str, str, int], "asyncio.Task[tuple[Activity, ...]]"] = {}
+# Bump when the cached value shapes change so stale files on disk are ignored
+_OTM_CACHE_VERSION = 2
+
+def _prune_cache(cache: Dict[Any, tuple[float, Any]]) -> None:
+    """
+    Drop expired entries, then the oldest ones until the cache fits _OTM_CACHE_MAX_ENTRIES.
+    Entries are (re)inserted on put, so insertion order is also expiry order.
+    """
+    now = time.time()
+    for key in [key for key, (expires_at, _) in cache.items() if expires_at < now]:
+        del cache[key]
+    while len(cache) > _OTM_CACHE_MAX_ENTRIES:
+        del cache[next(iter(cache))]
+
+def _load_otm_cache() -> None:
+    try:
+        with open(_OTM_CACHE_FILE, "rb") as fh:
+            stored = pickle.load(fh)
+        if stored.get("version") != _OTM_CACHE_VERSION:
+            return
+        _GEO_CACHE.update(stored.get("geo", {}))
+        _ACTIVITIES_CACHE.update(stored.get("activities", {}))
+        _prune_cache(_GEO_CACHE)
+        _prune_cache(_ACTIVITIES_CACHE)
+    except Exception:
+        # Missing or unreadable cache file just means a cold cache
+        pass
+
+def _write_otm_cache(snapshot: Dict[str, Any]) -> None:
+    # Write to a temp file and rename it into place so readers never see a partial pickle
+    cache_dir = _os.path.dirname(_OTM_CACHE_FILE)
+    _os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".otm-", suffix=".tmp")
+    try:
+        with _os.fdopen(fd, "wb") as fh:
+            pickle.dump(snapshot, fh)
+        _os.replace(tmp_path, _OTM_CACHE_FILE)
+    except BaseException:
+        _os.unlink(tmp_path)
+        raise
+
+async def _save_otm_cache() -> None:
+    """
+    Persist the caches without blocking the event loop: the snapshot is taken here, and the
+    pickling and file I/O run in a worker thread.
+    """
+    _prune_cache(_GEO_CACHE)
+    _prune_cache(_ACTIVITIES_CACHE)
+    snapshot = {"version": _OTM_CACHE_VERSION, "geo": dict(_GEO_CACHE), "activities": dict(_ACTIVITIES_CACHE)}
+    try:
+        await asyncio.to_thread(_write_otm_cache, snapshot)
+    except Exception:
+        logger.debug("Could not persist OpenTripMap cache to %s", _OTM_CACHE_FILE)
+
+def _cache_get(cache: Dict[Any, tuple[float, Any]], key: Any) -> Any:
+    entry = cache.get(key)
+    if entry is None:
+        logger.debug("OpenTripMap cache miss: %r", key)
+        return None
+    expires_at, value = entry
+    if expires_at < time.time():
+        logger.debug("OpenTripMap cache expired: %r", key)
+        cache.pop(key, None)
+        return None
+    logger.debug("OpenTripMap cache hit: %r", key)
+    return value
+
+def _cache_put(cache: Dict[Any, tuple[float, Any]], key: Any, value: Any) -> None:
+    cache.pop(key, None)
+    cache[key] = (time.time() + _OTM_CACHE_TTL_SECONDS, value)
+    if len(cache) > _OTM_CACHE_MAX_ENTRIES:
+        _prune_cache(cache)
+
+_load_otm_cache()
+
+# OpenTripMap kinds -> our category, checked in order (first match wins)
+_KIND_RULES: tuple[tuple[frozenset[str], str], ...] = (
+    (frozenset({"museums", "museum"}), "Museum"),
+    (frozenset({"theatres", "theatre"}), "Arts"),
+    (frozenset({"historic", "monuments"}), "History"),
+    (frozenset({"restaurants", "foods", "marketplaces"}), "Food"),
+    (frozenset({"hiking", "active", "trails"}), "Hiking"),
+    (frozenset({"water"}), "Water Sports"),
+    (frozenset({"parks", "gardens", "beaches"}), "Parks"),
+)
+
+def _map_kinds(kinds_str: str) -> str:
+    s = frozenset((kinds_str or "").split(","))
+    for rule, category in _KIND_RULES:
+        if not rule.isdisjoint(s):
+            return category
+    return "Sightseeing"
+
+# Shared HTTP sessions so TCP/TLS connections are reused across tool calls. aiohttp sessions
+# are bound to the event loop they were created on, so there is one per loop (e.g., when runs
+# get isolated loops); sessions whose loop has since closed are dropped on the next lookup.
+_HTTP_SESSIONS: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+async def _get_session() -> aiohttp.ClientSession:
+    loop = asyncio.get_running_loop()
+    for stale_loop in [other for other in _HTTP_SESSIONS if other.is_closed()]:
+        # Once its loop is closed the connector skips loop-bound teardown, so this only
+        # releases the pooled connections and never touches the dead loop
+        await _HTTP_SESSIONS.pop(stale_loop).close()
+    session = _HTTP_SESSIONS.get(loop)
+    if session is None or session.closed:
+        # permissive ssl for environments with cert issues
+        connector = aiohttp.TCPConnector(ssl=False, limit=16, limit_per_host=8, keepalive_timeout=60)
+        session = _HTTP_SESSIONS[loop] = aiohttp.ClientSession(connector=connector)
+    return session
+
+@atexit.register
+def _close_http_sessions() -> None:
+    for loop, session in list(_HTTP_SESSIONS.items()):
+        if session.closed or loop.is_running():
+            continue
+        try:
+            if loop.is_closed():
+                asyncio.run(session.close())
+            else:
+                loop.run_until_complete(session.close())
+        except Exception:
+            pass
+    _HTTP_SESSIONS.clear()
+
+async def _otm_get_json(url: str, params: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+    """
+    GET an OpenTripMap endpoint over the shared keep-alive session and decode the JSON body.
+    """
+    async with (await _get_session()).get(url, params=params, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+        resp.raise_for_status()
+        return orjson.loads(await resp.read())
 
-def _fetch_activities_from_api(destination: str, travel_style: str, limit: int = 9) -> List[Dict[str, Any]]:
+async def _fetch_activities_from_api_async(destination: str, travel_style: str, limit: int = 9) -> List[Activity]:
     """
     Attempt to fetch real activities using OpenTripMap API.
     Requires OPENTRIPMAP_API_KEY in environment. Falls back to [] on failure.
-    Returns a list of dicts: { name, description, category }.
+    Returns a list of Activity tuples.
+    Detail lookups are issued concurrently over the shared aiohttp session.
     """
     api_key = _os.getenv("OPENTRIPMAP_API_KEY")
     if not api_key:
@@ -109,225 +286,243 @@ def _fetch_activities_from_api(destination: str, travel_style: str, limit: int =
     }
     kinds = style_to_kinds.get(travel_style, style_to_kinds["balanced"])
 
-    try:
-        from urllib.parse import urlencode
-        from urllib.request import urlopen
-        import ssl as _ssl
-
-        # permissive ssl for environments with cert issues
-        _ctx = _ssl.create_default_context()
-        _ctx.check_hostname = False
-        _ctx.verify_mode = _ssl.CERT_NONE
-
-        # 1) Geocode the destination
-        geo_url = (
-            "https://api.opentripmap.com/0.1/en/places/geoname?"
-            + urlencode({"name": destination, "apikey": api_key})
+    activities_key = (destination.lower(), travel_style, limit)
+    cached = _cache_get(_ACTIVITIES_CACHE, activities_key)
+    if cached is not None:
+        return list(cached)
+
+    # Single-flight: parallel tool calls for the same destination/style share one fetch instead of
+    # each missing the cache and issuing the full geocode/radius/detail sequence
+    loop = asyncio.get_running_loop()
+    in_flight = _ACTIVITIES_IN_FLIGHT.get(activities_key)
+    if in_flight is None or in_flight.get_loop() is not loop:
+        in_flight = _ACTIVITIES_IN_FLIGHT[activities_key] = loop.create_task(
+            _request_activities(destination, kinds, activities_key, api_key)
         )
-        with urlopen(geo_url, context=_ctx, timeout=8) as resp:
-            geo = json.loads(resp.read().decode("utf-8"))
-        lon = geo.get("lon")
-        lat = geo.get("lat")
-        if lon is None or lat is None:
-            return []
+        in_flight.add_done_callback(lambda done: _forget_in_flight(activities_key, done))
+    # Shielded so one caller being cancelled doesn't abort the fetch the others are waiting on
+    return list(await asyncio.shield(in_flight))
+
+def _forget_in_flight(activities_key: tuple[str, str, int], task: "asyncio.Task[tuple[Activity, ...]]") -> None:
+    if _ACTIVITIES_IN_FLIGHT.get(activities_key) is task:
+        del _ACTIVITIES_IN_FLIGHT[activities_key]
+
+async def _request_activities(
+    destination: str,
+    kinds: str,
+    activities_key: tuple[str, str, int],
+    api_key: str,
+) -> tuple[Activity, ...]:
+    """
+    Fetch and cache the activities for one _ACTIVITIES_CACHE key. Returns () on failure.
+    """
+    dest_key, _, limit = activities_key
+    try:
+        # 1) Geocode the destination (cached per destination)
+        coords = _cache_get(_GEO_CACHE, dest_key)
+        if coords is None:
+            geo = await _otm_get_json(
+                "https://api.opentripmap.com/0.1/en/places/geoname",
+                {"name": destination, "apikey": api_key},
+                8,
+            )
+            if geo.get("lon") is None or geo.get("lat") is None:
+                return ()
+            coords = (geo["lon"], geo["lat"])
+            _cache_put(_GEO_CACHE, dest_key, coords)
+        lon, lat = coords
 
         # 2) Search places by radius
-        radius_url = (
-            "https://api.opentripmap.com/0.1/en/places/radius?"
-            + urlencode({
+        data = await _otm_get_json(
+            "https://api.opentripmap.com/0.1/en/places/radius",
+            {
                 "radius": 10000,
                 "lon": lon,
                 "lat": lat,
                 "kinds": kinds,
                 "limit": max(3, min(limit, 30)),
                 "apikey": api_key,
-            })
+            },
+            12,
         )
-        with urlopen(radius_url, context=_ctx, timeout=12) as resp:
-            data = json.loads(resp.read().decode("utf-8"))
-        features = data.get("features", [])
-
-        # helper to map kinds -> our category
-        def map_kinds_to_category(kinds_str: str) -> str:
-            ks = (kinds_str or "").split(",")
-            s = set(ks)
-            if {"museums", "museum"} & s:
-                return "Museum"
-            if {"theatres", "theatre"} & s:
-                return "Arts"
-            if {"historic", "monuments"} & s:
-                return "History"
-            if {"restaurants", "foods", "marketplaces"} & s:
-                return "Food"
-            if {"hiking", "active", "trails"} & s:
-                return "Hiking"
-            if {"water"} & s:
-                return "Water Sports"
-            if {"parks", "gardens", "beaches"} & s:
-                return "Parks"
-            return "Sightseeing"
-
-        # Optionally fetch descriptions via detail endpoint for the first few
-        results: List[Dict[str, Any]] = []
-        detail_base = "https://api.opentripmap.com/0.1/en/places/xid/"
+        features = data.get("features", [])[:limit]
 
+        results: List[Activity] = []
+        xids: List[str | None] = []
+        # Keep one activity per name (unnamed places all become "Point of Interest"), so the
+        # round-robin scheduling never lists the same place twice in a day
+        seen_names: set[str] = set()
         for f in features:
             props = f.get("properties", {})
             name = props.get("name") or "Point of Interest"
-            kinds_str = props.get("kinds", "")
-            xid = props.get("xid")
-            category = map_kinds_to_category(kinds_str)
-            description = f"A {category.lower()} in {destination}."
-            if xid and len(results) < 6:
-                try:
-                    with urlopen(f"{detail_base}{xid}?" + urlencode({"apikey": api_key}), context=_ctx, timeout=8) as r:
-                        det = json.loads(r.read().decode("utf-8"))
-                    w = det.get("wikipedia_extracts", {})
-                    snippet = (w.get("text") or "").strip()
-                    if snippet:
-                        description = snippet.split(". ")[0].strip()
-                except Exception:
-                    pass
-            results.append({
-                "name": name,
-                "description": description,
-                "category": category,
-            })
-            if len(results) >= limit:
-                break
-
-        return results
+            if name in seen_names:
+                continue
+            seen_names.add(name)
+            category = _map_kinds(props.get("kinds", ""))
+            results.append(Activity(
+                name=name,
+                description=f"A {category.lower()} in {destination}.",
+                category=category,
+            ))
+            xids.append(props.get("xid"))
+
+        # 3) Optionally fetch descriptions via detail endpoint for the first few, in parallel
+        detail_base = "https://api.opentripmap.com/0.1/en/places/xid/"
+        detail_slots = [i for i, xid in enumerate(xids[:6]) if xid]
+        details = await asyncio.gather(
+            *[_otm_get_json(f"{detail_base}{xids[i]}", {"apikey": api_key}, 8) for i in detail_slots],
+            return_exceptions=True,
+        )
+        for i, det in zip(detail_slots, details):
+            if isinstance(det, BaseException):
+                continue
+            w = det.get("wikipedia_extracts", {})
+            snippet = (w.get("text") or "").strip()
+            if snippet:
+                results[i] = results[i]._replace(description=snippet.split(". ")[0].strip())
+
+        if results:
+            _cache_put(_ACTIVITIES_CACHE, activities_key, tuple(results))
+            await _save_otm_cache()
+        return tuple(results)
     except Exception:
-        return []
-
+        return ()
+
+
+# Static lookup tables for itinerary generation (shared, read-only)
+_CURRENCY_MAP = MappingProxyType({
+    "tokyo": MappingProxyType({"code": "JPY", "symbol": "¥"}),
+    "paris": MappingProxyType({"code": "EUR", "symbol": "€"}),
+    "bali": MappingProxyType({"code": "IDR", "symbol": "Rp"}),
+})
+_DEFAULT_CURRENCY = MappingProxyType({"code": "USD", "symbol": "$"})
+# Rough currency scaling factors from USD baselines; improves realism
+_SCALE_MAP = MappingProxyType({"USD": 1.0, "EUR": 0.95, "JPY": 150.0, "IDR": 16000.0})
+_ROUNDING_UNIT = MappingProxyType({"USD": 1, "EUR": 1, "JPY": 50, "IDR": 1000})
+
+# Specific activities catalog by style (used as fallback)
+_CATALOG = MappingProxyType({
+    "adventure": (
+        Activity("Scenic Hiking Trail", "Half-day hike with panoramic views.", "Hiking"),
+        Activity("Kayaking Experience", "Guided paddle through calm waters.", "Water Sports"),
+        Activity("Sunset Viewpoint", "Short climb to catch golden hour.", "Outdoors"),
+    ),
+    "relaxed": (
+        Activity("Spa & Wellness Session", "45–60 min massage or spa treatment.", "Wellness"),
+        Activity("Cafe Hopping", "Leisurely cafes with pastries and coffee.", "Leisure"),
+        Activity("Park Stroll", "Light walk under trees and gardens.", "Parks"),
+    ),
+    "cultural": (
+        Activity("Heritage Museum Visit", "Explore key exhibits and galleries.", "Museum"),
+        Activity("Historic District Walk", "Streets with architecture and landmarks.", "History"),
+        Activity("Theater or Live Show", "Local performance for an evening.", "Arts"),
+    ),
+    "food": (
+        Activity("Market Food Tour", "Taste local bites and specialties.", "Food"),
+        Activity("Cooking Class", "Hands-on class making regional dishes.", "Class"),
+        Activity("Street Eats Crawl", "Popular snacks across a few blocks.", "Food"),
+    ),
+    "balanced": (
+        Activity("City Highlights Walk", "Iconic spots in a compact route.", "Sightseeing"),
+        Activity("Local Lunch Spot", "Casual eatery with regional flavors.", "Food"),
+        Activity("Riverside Evening", "Sunset views and light snacks.", "Leisure"),
+    ),
+})
+
+# Simple per-activity cost estimates (in local currency where possible)
+# These are approximate and can be refined later via real APIs.
+# Baseline per-activity costs in USD-equivalents
+_BASELINE_COSTS = MappingProxyType({
+    "Hiking": 0,
+    "Water Sports": 40,
+    "Outdoors": 0,
+    "Wellness": 50,
+    "Leisure": 12,
+    "Parks": 0,
+    "Museum": 18,
+    "History": 0,
+    "Arts": 45,
+    "Food": 22,
+    "Class": 55,
+    "Sightseeing": 0,
+})
+
+_DAY_PART_LABELS = ("Morning", "Afternoon", "Evening")
+_DAY_NOTES = (
+    "Pre-book one key activity",
+    "Group nearby sights to minimize transit",
+    "Consider a day transit pass",
+)
+
+@lru_cache(maxsize=1024)
+def _to_money(amount_usd: float, code: str, scale: float, unit: int) -> tuple[int, str]:
+    """
+    Convert a USD baseline into a rounded local-currency estimate.
+    Only a handful of distinct amounts exist per currency, so results are memoized.
+    """
+    raw = amount_usd * scale
+    # round to nearest unit for local currency conventions
+    rounded = int(max(0, round(raw / unit) * unit))
+    return rounded, code
 
-def _generate_itinerary_data(destination: str, duration_days: int, travel_style: str) -> Dict[str, Any]:
+async def _generate_itinerary_data(destination: str, duration_days: int, travel_style: str) -> Dict[str, Any]:
     """
     Build a structured itinerary JSON with specific activity names, one-liners, and cost estimates.
     """
+    duration_days = max(1, min(int(duration_days), 14))
     # Basic currency inference for a few known places
-    currency_map = {
-        "tokyo": {"code": "JPY", "symbol": "¥"},
-        "paris": {"code": "EUR", "symbol": "€"},
-        "bali": {"code": "IDR", "symbol": "Rp"},
-    }
     dest_key = destination.lower()
-    currency = currency_map.get(dest_key, {"code": "USD", "symbol": "$"})
-    # Rough currency scaling factors from USD baselines; improves realism
-    scale_map = {"USD": 1.0, "EUR": 0.95, "JPY": 150.0, "IDR": 16000.0}
-    rounding_unit = {"USD": 1, "EUR": 1, "JPY": 50, "IDR": 1000}
-    scale = scale_map.get(currency["code"], 1.0)
-    unit = rounding_unit.get(currency["code"], 1)
+    currency = _CURRENCY_MAP.get(dest_key, _DEFAULT_CURRENCY)
+    scale = _SCALE_MAP.get(currency["code"], 1.0)
+    unit = _ROUNDING_UNIT.get(currency["code"], 1)
 
     def to_money(amount_usd: float) -> Dict[str, Any]:
-        raw = amount_usd * scale
-        # round to nearest unit for local currency conventions
-        rounded = int(max(0, round(raw / unit) * unit))
-        return {"estimate": rounded, "currency": currency["code"]}
-
-    # Try real data first
-    fetched = _fetch_activities_from_api(destination, travel_style, limit=max(6, duration_days * 3))
-
-    # Specific activities catalog by style (used as fallback)
-    catalog: Dict[str, List[Dict[str, Any]]] = {
-        "adventure": [
-            {"name": "Scenic Hiking Trail", "description": "Half-day hike with panoramic views.", "category": "Hiking"},
-            {"name": "Kayaking Experience", "description": "Guided paddle through calm waters.", "category": "Water Sports"},
-            {"name": "Sunset Viewpoint", "description": "Short climb to catch golden hour.", "category": "Outdoors"},
-        ],
-        "relaxed": [
-            {"name": "Spa & Wellness Session", "description": "45–60 min massage or spa treatment.", "category": "Wellness"},
-            {"name": "Cafe Hopping", "description": "Leisurely cafes with pastries and coffee.", "category": "Leisure"},
-            {"name": "Park Stroll", "description": "Light walk under trees and gardens.", "category": "Parks"},
-        ],
-        "cultural": [
-            {"name": "Heritage Museum Visit", "description": "Explore key exhibits and galleries.", "category": "Museum"},
-            {"name": "Historic District Walk", "description": "Streets with architecture and landmarks.", "category": "History"},
-            {"name": "Theater or Live Show", "description": "Local performance for an evening.", "category": "Arts"},
-        ],
-        "food": [
-            {"name": "Market Food Tour", "description": "Taste local bites and specialties.", "category": "Food"},
-            {"name": "Cooking Class", "description": "Hands-on class making regional dishes.", "category": "Class"},
-            {"name": "Street Eats Crawl", "description": "Popular snacks across a few blocks.", "category": "Food"},
-        ],
-        "balanced": [
-            {"name": "City Highlights Walk", "description": "Iconic spots in a compact route.", "category": "Sightseeing"},
-            {"name": "Local Lunch Spot", "description": "Casual eatery with regional flavors.", "category": "Food"},
-            {"name": "Riverside Evening", "description": "Sunset views and light snacks.", "category": "Leisure"},
-        ],
-    }
-    activities = fetched if fetched else catalog.get(travel_style, catalog["balanced"])
-
-    # Simple per-activity cost estimates (in local currency where possible)
-    # These are approximate and can be refined later via real APIs.
-    # Baseline per-activity costs in USD-equivalents
-    baseline_costs = {
-        "Hiking": 0,
-        "Water Sports": 40,
-        "Outdoors": 0,
-        "Wellness": 50,
-        "Leisure": 12,
-        "Parks": 0,
-        "Museum": 18,
-        "History": 0,
-        "Arts": 45,
-        "Food": 22,
-        "Class": 55,
-        "Sightseeing": 0,
-    }
+        estimate, code = _to_money(amount_usd, currency["code"], scale, unit)
+        return {"estimate": estimate, "currency": code}
+
+    # Try real data first; an empty travel style means a generic template, so skip the API round-trip
+    fetched = (
+        await _fetch_activities_from_api_async(destination, travel_style, limit=max(6, duration_days * 3))
+        if travel_style
+        else []
+    )
+    activities = fetched if fetched else _CATALOG.get(travel_style, _CATALOG["balanced"])
 
-    def activity_cost(category: str) -> Dict[str, Any]:
-        amount = baseline_costs.get(category, 0)
-        return to_money(amount)
+    def activity_cost(category: str) -> int:
+        return _to_money(_BASELINE_COSTS.get(category, 0), currency["code"], scale, unit)[0]
 
     # Build days with morning/afternoon/evening parts
     days: List[Dict[str, Any]] = []
-    # Diversify activities: spread sequentially across days without repeating within a day
-    labels = ["Morning", "Afternoon", "Evening"]
-    total_needed = duration_days * len(labels)
-    if len(activities) < total_needed:
-        # Extend the pool slightly by cycling but we will still avoid same-activity within a day
-        pass
+    # Diversify activities: round-robin across days; consecutive slots never repeat within a day
+    # as long as the pool has at least as many activities as there are day parts
+    labels = _DAY_PART_LABELS
+    n = len(activities)
+    # Accumulate the activity total while building days instead of re-walking them afterwards
+    activities_total = 0
     for i in range(duration_days):
         parts: List[Dict[str, Any]] = []
-        start = (i * len(labels)) % len(activities)
-        used_names: set[str] = set()
+        start = i * len(labels)
         for j, label in enumerate(labels):
-            k = (start + j) % len(activities)
-            # ensure uniqueness within the day
-            spins = 0
-            while activities[k]["name"] in used_names and spins < len(activities):
-                k = (k + 1) % len(activities)
-                spins += 1
-            act = activities[k]
-            used_names.add(act["name"])
+            act = activities[(start + j) % n]
+            cost = activity_cost(act.category)
+            activities_total += cost
             parts.append({
                 "timeOfDay": label,
                 "activity": {
-                    "name": act["name"],
-                    "description": act["description"],
-                    "category": act["category"],
+                    "name": act.name,
+                    "description": act.description,
+                    "category": act.category,
                     "location": destination,
                 },
-                "cost": activity_cost(act["category"]),
+                "cost": {"estimate": cost, "currency": currency["code"]},
             })
         days.append({
             "day": i + 1,
             "parts": parts,
-            "notes": [
-                "Pre-book one key activity",
-                "Group nearby sights to minimize transit",
-                "Consider a day transit pass",
-            ],
+            "notes": list(_DAY_NOTES),
         })
 
     # High-level cost breakdown (very rough mock values)
-    # Compute activity total from day parts
-    activities_total = 0
-    for d in days:
-        for p in d["parts"]:
-            activities_total += int(p["cost"]["estimate"])
-
     # Scaled baseline components
     flights_money = to_money(600)
     acc_per_night_money = to_money(120)
@@ -341,15 +536,14 @@ def _generate_itinerary_data(destination: str, duration_days: int, travel_style:
         "localTransportPerDay": local_transport_per_day_money,
         "foodPerDay": food_per_day_money,
     }
-    total_estimate = (
-        flights_money["estimate"]
-        + acc_per_night_money["estimate"] * duration_days
-        + activities_total
-        + local_transport_per_day_money["estimate"] * duration_days
-        + food_per_day_money["estimate"] * duration_days
+    per_day_estimate = (
+        acc_per_night_money["estimate"]
+        + local_transport_per_day_money["estimate"]
+        + food_per_day_money["estimate"]
     )
+    total_estimate = flights_money["estimate"] + activities_total + per_day_estimate * duration_days
 
-    checklist_data = _generate_checklist(destination=destination, context="Trip")["data"]
+    checklist_markdown, checklist_json_tag, checklist_json = _generate_checklist_cached(destination, "Trip")
 
     payload: Dict[str, Any] = {
         "type": "itinerary",
@@ -357,17 +551,19 @@ def _generate_itinerary_data(destination: str, duration_days: int, travel_style:
         "destination": destination,
         "durationDays": duration_days,
         "travelStyle": travel_style,
-        "currency": currency,
+        "currency": dict(currency),
         "days": days,
         "summary": {
             "estimatedTotalCost": {"estimate": total_estimate, "currency": currency["code"]},
             "breakdown": breakdown,
         },
-        "checklist": checklist_data,
+        # Embed the cached checklist JSON as-is instead of parsing and re-encoding it
+        "checklist": orjson.Fragment(checklist_json),
     }
 
-    json_tag = "```json itinerary\n" + json.dumps(payload, ensure_ascii=False) + "\n```"
-    return {"data": payload, "json_tag": json_tag}
+    json_tag = "```json itinerary\n" + orjson.dumps(payload).decode("utf-8") + "\n```"
+    checklist = {"markdown": checklist_markdown, "json_tag": checklist_json_tag}
+    return {"data": payload, "json_tag": json_tag, "checklist": checklist}
 
 @tool
 def research_destination(destination: str, interests: str = "general"):
@@ -444,7 +640,7 @@ def research_destination(destination: str, interests: str = "general"):
     return result
 
 @tool
-def create_itinerary_template(destination: str, duration_days: int, travel_style: str = "balanced"):
+async def create_itinerary_template(destination: str, duration_days: int, travel_style: str = "balanced"):
     """
     Create a structured itinerary template for a destination.
     
@@ -454,8 +650,7 @@ def create_itinerary_template(destination: str, duration_days: int, travel_style
         travel_style: 'adventure', 'relaxed', 'cultural', 'food', or 'balanced'
     """
     
-    if duration_days > 14:
-        duration_days = 14  # Cap at 2 weeks for template
+    duration_days = max(1, min(int(duration_days), 14))  # 1 day minimum, cap at 2 weeks for template
     
     style_activities = {
         "adventure": ["hiking", "outdoor activities", "adventure sports", "exploration"],
@@ -498,33 +693,43 @@ def create_itinerary_template(destination: str, duration_days: int, travel_style
     default_notes = style_notes.get(travel_style, style_notes["balanced"])
     
     # JSON-tagged itinerary block for frontend
-    itinerary = _generate_itinerary_data(destination, duration_days, travel_style)
-    template = f"""## 🗓️ {destination.title()} Itinerary ({duration_days} Days)
+    itinerary = await _generate_itinerary_data(destination, duration_days, travel_style)
+    parts: List[str] = [f"""## 🗓️ {destination.title()} Itinerary ({duration_days} Days)
 
 *Travel Style: {travel_style.title()}*
 
 {itinerary['json_tag']}
 
-"""
+"""]
     
     # Keep a minimal text fallback for non-JSON renderers
-    for day in range(1, duration_days + 1):
-        template += f"""### Day {day}
+    parts.extend(
+        f"""### Day {day}
 Summary: See structured itinerary above.
 
 ---
 
 """
+        for day in range(1, duration_days + 1)
+    )
     
     # Generated checklist with JSON tag for frontend parsing (emit once here)
-    checklist = _generate_checklist(destination=destination, context="Trip")
-    template += f"""{checklist['json_tag']}
+    parts.append(f"""{itinerary['checklist']['json_tag']}
 
 ## 💡 Tips & Notes
 *Add your own insights and discoveries here...*
-"""
+""")
     
-    return template
+    return "".join(parts)
+
+# Travel planning elements checked by suggest_improvements: group -> (keywords, suggestion if missing)
+_KEYWORD_GROUPS = MappingProxyType({
+    "itinerary": (("itinerary", "day"), "🗓️ **Add an itinerary** - Consider creating a day-by-day schedule for your trip."),
+    "budget": (("budget", "cost"), "💰 **Include budget planning** - Add estimated costs and budget considerations."),
+    "accommodation": (("accommodation", "hotel"), "🏨 **Add accommodation details** - Include where you plan to stay."),
+    "transport": (("transport", "flight"), "✈️ **Add transportation info** - Include flight details and local transport options."),
+})
+_KEYWORD_RE = _re_user.compile("(?i)" + "|".join(kw for keywords, _ in _KEYWORD_GROUPS.values() for kw in keywords))
 
 @tool
 def suggest_improvements(current_content: str, focus_area: str = "general"):
@@ -542,18 +747,11 @@ def suggest_improvements(current_content: str, focus_area: str = "general"):
     if len(current_content) < 500:
         suggestions.append("📝 **Add more detail** - Your document could benefit from more specific information and planning details.")
     
-    # Check for common travel planning elements
-    if "itinerary" not in current_content.lower() and "day" not in current_content.lower():
-        suggestions.append("🗓️ **Add an itinerary** - Consider creating a day-by-day schedule for your trip.")
-    
-    if "budget" not in current_content.lower() and "cost" not in current_content.lower():
-        suggestions.append("💰 **Include budget planning** - Add estimated costs and budget considerations.")
-    
-    if "accommodation" not in current_content.lower() and "hotel" not in current_content.lower():
-        suggestions.append("🏨 **Add accommodation details** - Include where you plan to stay.")
-    
-    if "transport" not in current_content.lower() and "flight" not in current_content.lower():
-        suggestions.append("✈️ **Add transportation info** - Include flight details and local transport options.")
+    # Check for common travel planning elements in a single pass over the content
+    found = {m.group().lower() for m in _KEYWORD_RE.finditer(current_content)}
+    for keywords, suggestion in _KEYWORD_GROUPS.values():
+        if found.isdisjoint(keywords):
+            suggestions.append(suggestion)
     
     # Structure suggestions
     if current_content.count("#") < 3:
@@ -577,31 +775,14 @@ def suggest_improvements(current_content: str, focus_area: str = "general"):
             "🤝 **Collaboration notes** - Areas where team members can add their input."
         ]
     
-    result = "## 💡 Suggested Improvements\n\n" + "\n".join(suggestions)
-    result += "\n\n*What would you like me to help you add or improve?*"
-    
-    return result
-
-@tool
-def add_planning_section(section_type: str, topic: str = ""):
-    """
-    Add a new structured section to the planning document.
-    
-    Args:
-        section_type: Type of section - 'checklist', 'budget', 'packing', 'research', 'contacts'
-        topic: Specific topic for the section (optional)
-    """
-    
-    sections = {
-        "checklist": (lambda: (
-            (lambda payload: (
-                f"""{payload['markdown']}
+    return "".join([
+        "## 💡 Suggested Improvements\n\n",
+        "\n".join(suggestions),
+        "\n\n*What would you like me to help you add or improve?*",
+    ])
 
-{payload['json_tag']}"""
-            ))(_generate_checklist(destination=topic or "", context="Trip"))
-        ))(),
-        
-        "budget": f"""## 💰 {topic or 'Trip'} Budget
+# Section templates for add_planning_section, filled with str.format(topic=...)
+_BUDGET_TEMPLATE = """## 💰 {topic} Budget
 
 ### Estimated Costs
 | Category | Estimated Cost | Actual Cost | Notes |
@@ -619,9 +800,9 @@ def add_planning_section(section_type: str, topic: str = ""):
 - 
 - 
 - 
-""",
-        
-        "packing": f"""## 🎒 {topic or 'Trip'} Packing List
+"""
+
+_PACKING_TEMPLATE = """## 🎒 {topic} Packing List
 
 ### Essentials
 - [ ] Passport/ID
@@ -651,9 +832,9 @@ def add_planning_section(section_type: str, topic: str = ""):
 - [ ] Snacks
 - [ ] Gifts for locals
 - [ ] Extra memory cards
-""",
-        
-        "research": f"""## 📚 {topic or 'Destination'} Research Notes
+"""
+
+_RESEARCH_TEMPLATE = """## 📚 {topic} Research Notes
 
 ### Key Information
 **Language:** 
@@ -678,9 +859,9 @@ def add_planning_section(section_type: str, topic: str = ""):
 - 
 - 
 - 
-""",
-        
-        "contacts": f"""## 📞 {topic or 'Emergency'} Contacts
+"""
+
+_CONTACTS_TEMPLATE = """## 📞 {topic} Contacts
 
 ### Emergency Services
 **Local Emergency Number:** 
@@ -704,9 +885,29 @@ def add_planning_section(section_type: str, topic: str = ""):
 **Travel Insurance:** 
 **Airline:** 
 """
-    }
+
+@tool
+def add_planning_section(section_type: str, topic: str = ""):
+    """
+    Add a new structured section to the planning document.
     
-    return sections.get(section_type, f"# {topic or section_type.title()}\n\n*Add your content here...*")
+    Args:
+        section_type: Type of section - 'checklist', 'budget', 'packing', 'research', 'contacts'
+        topic: Specific topic for the section (optional)
+    """
+    
+    if section_type == "checklist":
+        markdown, json_tag, _ = _generate_checklist_cached(topic or "", "Trip")
+        return f"{markdown}\n\n{json_tag}"
+    elif section_type == "budget":
+        return _BUDGET_TEMPLATE.format(topic=topic or "Trip")
+    elif section_type == "packing":
+        return _PACKING_TEMPLATE.format(topic=topic or "Trip")
+    elif section_type == "research":
+        return _RESEARCH_TEMPLATE.format(topic=topic or "Destination")
+    elif section_type == "contacts":
+        return _CONTACTS_TEMPLATE.format(topic=topic or "Emergency")
+    return f"# {topic or section_type.title()}\n\n*Add your content here...*"
 
 backend_tools = [
     research_destination,
@@ -716,61 +917,31 @@ backend_tools = [
 ]
 
 # Extract tool names from backend_tools for comparison
-backend_tool_names = [tool.name for tool in backend_tools]
+backend_tool_names = frozenset(tool.name for tool in backend_tools)
 
 
-"""
-Eagerly initialize the Gemini chat model at import time to avoid blocking I/O
-inside the event loop (e.g., metadata reads performed during first use).
-"""
 import os as _os
 _DEFAULT_GEMINI_MODEL = _os.getenv("GEMINI_MODEL") or _os.getenv("MODEL_NAME") or "gemini-2.5-flash"
-_GEMINI_MODEL = ChatGoogleGenerativeAI(model=_DEFAULT_GEMINI_MODEL)
-try:
-    _ = _GEMINI_MODEL.async_client  # force client creation outside event loop
-except Exception:
-    # Defer missing-key or other errors to runtime where they'll surface clearly
-    pass
 
 
-async def chat_node(state: AgentState, config: RunnableConfig) -> Command[Literal["tool_node", "__end__"]]:
+@cache
+def _get_model() -> ChatGoogleGenerativeAI:
     """
-    Standard chat node based on the ReAct design pattern. It handles:
-    - The model to use (and binds in CopilotKit actions and the tools defined above)
-    - The system prompt
-    - Getting a response from the model
-    - Handling tool calls
-
-    For more about the ReAct design pattern, see:
-    https://www.perplexity.ai/search/react-agents-NcXLQhreS0WDzpVaS4m9Cg
+    Lazily create the Gemini chat model once per process, keeping import (and forked
+    workers) free of client setup. Call it via asyncio.to_thread so the blocking I/O
+    done on first use (e.g., metadata reads) stays off the event loop.
     """
+    model = ChatGoogleGenerativeAI(model=_DEFAULT_GEMINI_MODEL)
+    try:
+        _ = model.async_client  # force client creation up front
+    except Exception:
+        # Defer missing-key or other errors to runtime where they'll surface clearly
+        pass
+    return model
 
-    # 1. Use the eagerly initialized Gemini model
-    model = _GEMINI_MODEL
-
-    # 2. Bind the tools to the model
-    model_with_tools = model.bind_tools(
-        [
-            *state.get("tools", []), # bind tools defined by ag-ui
-            *backend_tools,
-            # your_tool_here
-        ],
 
-        # 2.1 Disable parallel tool calls to avoid race conditions,
-        #     enable this for faster performance if you want to manage
-        #     the complexity of running tool calls in parallel.
-        parallel_tool_calls=False,
-    )
-
-    # 3. Define the system message for travel planning and collaboration
-    # Prepare shared group/document context
-    group_id = state.get("group_id") or state.get("groupId") or "Solo planning session"
-    content_str = state.get("content") or ""
-    # Limit injected document to avoid excessive prompt size
-    max_chars = 8000
-    doc_snapshot = content_str[:max_chars]
-    system_message = SystemMessage(
-        content=f"""You are Frizzle, an expert AI travel planning and brainstorming assistant. Your specialty is helping individuals and groups create amazing collaborative documents for travel plans, research projects, startup ideas, and more.
+# Static parts of the system prompt; only the group id and document snapshot between them change per turn
+_SYSTEM_PROMPT_PREFIX = """You are Frizzle, an expert AI travel planning and brainstorming assistant. Your specialty is helping individuals and groups create amazing collaborative documents for travel plans, research projects, startup ideas, and more.
 
 CORE CAPABILITIES:
 🌍 Travel Planning: Research destinations, create itineraries, suggest activities
@@ -785,10 +956,16 @@ PERSONALITY & TONE:
 - Clear and organized in your responses
 
 CURRENT CONTEXT:
-- Group ID: {group_id}
-- Current document (markdown snapshot):\n\n```markdown\n{doc_snapshot}\n```
+- Group ID: """
 
-AVAILABLE TOOLS:
+_SYSTEM_PROMPT_MIDDLE = """
+- Current document (markdown snapshot):\n\n```markdown\n"""
+
+_SYSTEM_PROMPT_SUFFIX_HEAD = "\n```\n\n"
+
+# Prompt sections after the document snapshot, kept separate so each turn includes only the
+# ones that apply (document-editing rules are skipped while the shared document is empty)
+_PROMPT_TOOLS = """AVAILABLE TOOLS:
 - research_destination: Get detailed info about travel destinations
 - create_itinerary_template: Build structured day-by-day plans
 - suggest_improvements: Analyze content and recommend enhancements
@@ -796,7 +973,9 @@ AVAILABLE TOOLS:
 - updateDocument: Update the main document content (via frontend action)
 - addSection: Add new sections to the document (via frontend action)
 
-GUIDELINES:
+"""
+
+_PROMPT_GUIDELINES = """GUIDELINES:
 1. Always ask clarifying questions when requests are vague
 2. Suggest specific, actionable improvements to documents
 3. Use your tools proactively to provide detailed, helpful information
@@ -804,71 +983,423 @@ GUIDELINES:
 5. Keep content well-structured with clear headings and organization
 6. Be mindful that multiple people may be contributing to the same document
 
-SOURCE OF TRUTH POLICY:
+"""
+
+_PROMPT_SOURCE_OF_TRUTH = """SOURCE OF TRUTH POLICY:
 - The shared document snapshot above is the canonical state for the plan. If prior chat messages conflict with the document, prefer the document.
 - Do NOT change the trip duration unless explicitly asked to do so. When a user asks to modify a single day (e.g., "visit X on Day 2"), update only that day's content and preserve the current total duration from the document.
 - When the duration is explicitly changed, update the itinerary header (e.g., "Itinerary (N Days)") and day sections accordingly, then call 'updateDocument' with the fully updated markdown.
 
-CRITICAL TOOL USAGE:
+"""
+
+_PROMPT_TOOL_USAGE = """CRITICAL TOOL USAGE:
 7. Whenever you generate content meant for the shared document, you MUST call the 'updateDocument' action with the FULL updated markdown (merge your changes into the existing content). Do not only reply in chat.
 8. If the user asks to add a specific section, prefer calling 'addSection' (frontend action) and then 'updateDocument' with the resulting content if needed.
 9. After using backend tools (e.g., research_destination, create_itinerary_template), integrate their results into the document by calling 'updateDocument' so collaborators see changes in the editor.
 10. JSON RENDERING REQUIREMENT: For itineraries or checklists, always use the tools that emit fenced JSON tags (create_itinerary_template and add_planning_section with "checklist"). Do not write free-form markdown versions without these JSON fences, or the frontend cannot render the rich components.
 
-SPECIAL HANDLING FOR EDIT REQUESTS:
+"""
+
+_PROMPT_EDIT_HANDLING = """SPECIAL HANDLING FOR EDIT REQUESTS:
 - If a user requests adjustments (e.g., "make the trip 5 days instead of 4"), infer missing details like destination or current duration from the existing document snapshot above. Do not re-ask for data that is already present in the document unless it is ambiguous.
 - When changing durations, update all day headers and related content accordingly, then call 'updateDocument' with the full updated markdown.
 
-Remember: Your goal is to help create comprehensive, useful documents that serve as excellent planning resources for individuals or groups!"""
+"""
+
+_PROMPT_CLOSING = """Remember: Your goal is to help create comprehensive, useful documents that serve as excellent planning resources for individuals or groups!"""
+
+_PROMPT_SECTIONS = (
+    _PROMPT_TOOLS,
+    _PROMPT_GUIDELINES,
+    _PROMPT_SOURCE_OF_TRUTH,
+    _PROMPT_TOOL_USAGE,
+    _PROMPT_EDIT_HANDLING,
+    _PROMPT_CLOSING,
+)
+
+def _build_prompt_suffix(flags: tuple[bool, ...]) -> str:
+    return _SYSTEM_PROMPT_SUFFIX_HEAD + "".join(section for section, enabled in zip(_PROMPT_SECTIONS, flags) if enabled)
+
+# Both variants are assembled once at import, keyed by whether the document has content
+_SYSTEM_PROMPT_SUFFIXES = {
+    has_document: _build_prompt_suffix((True, True, has_document, True, has_document, True))
+    for has_document in (False, True)
+}
+
+_MAX_DOC_BYTES = 16000
+
+# Token budget for chat history sent with each turn. Counted approximately so trimming
+# never needs a round-trip to the model's token counting endpoint.
+_HISTORY_MAX_TOKENS = 4096
+_TOKEN_COUNTER = count_tokens_approximately
+
+def _history_window(messages: List[Any]) -> List[Any]:
+    """
+    The chat history to send with this turn: the whole in-progress turn (from the latest human
+    message on, so tool results always keep their AIMessage), preceded by as many complete older
+    turns as fit in what is left of _HISTORY_MAX_TOKENS.
+    """
+    turn_start = next((i for i in range(len(messages) - 1, -1, -1) if isinstance(messages[i], HumanMessage)), 0)
+    current_turn = messages[turn_start:]
+    budget = _HISTORY_MAX_TOKENS - _TOKEN_COUNTER(current_turn)
+    if budget <= 0 or not turn_start:
+        return current_turn
+    older_turns = trim_messages(
+        messages[:turn_start],
+        max_tokens=budget,
+        strategy="last",
+        token_counter=_TOKEN_COUNTER,
+        start_on="human",
+        include_system=False,
+        allow_partial=False,
     )
+    return [*older_turns, *current_turn]
+
+# Rendered system messages keyed by (group_id, blake2b digest of the raw document), in LRU order
+_SYSTEM_MESSAGE_CACHE: "OrderedDict[tuple[str, bytes], SystemMessage]" = OrderedDict()
+_SYSTEM_MESSAGE_CACHE_SIZE = 64
+
+def _build_system_message(group_id: str, content_str: str) -> SystemMessage:
+    """
+    Build the system message for a group/document pair. Cached by a short hash of the raw
+    document, so turns against an unchanged document skip truncating and
+    re-rendering the snapshot (the common case mid-conversation).
+    """
+    key = (group_id, hashlib.blake2b(content_str.encode("utf-8"), digest_size=8).digest())
+    system_message = _SYSTEM_MESSAGE_CACHE.get(key)
+    if system_message is not None:
+        _SYSTEM_MESSAGE_CACHE.move_to_end(key)
+        return system_message
+
+    # Limit injected document to avoid excessive prompt size. Bound by UTF-8 bytes rather than
+    # characters so multi-byte scripts can't blow up the prompt. Whitespace is left untouched: the
+    # model sends the full document back, and trailing spaces are markdown hard line breaks.
+    doc_snapshot = content_str.encode("utf-8")[:_MAX_DOC_BYTES].decode("utf-8", "ignore")
+    # The content is always a plain str we assembled ourselves, so skip pydantic validation
+    system_message = SystemMessage.model_construct(
+        content=_SYSTEM_PROMPT_PREFIX + group_id + _SYSTEM_PROMPT_MIDDLE + doc_snapshot
+        + _SYSTEM_PROMPT_SUFFIXES[bool(doc_snapshot.strip())]
+    )
+    _SYSTEM_MESSAGE_CACHE[key] = system_message
+    if len(_SYSTEM_MESSAGE_CACHE) > _SYSTEM_MESSAGE_CACHE_SIZE:
+        _SYSTEM_MESSAGE_CACHE.popitem(last=False)
+    return system_message
+
+# Tool-bound models keyed by a digest of the ag-ui tool definitions, in LRU order
+_BOUND_MODEL_CACHE: "OrderedDict[bytes, Any]" = OrderedDict()
+_BOUND_MODEL_CACHE_SIZE = 16
+
+def _bind_tools(model: ChatGoogleGenerativeAI, frontend_tools: List[Any]) -> Any:
+    """
+    Bind frontend and backend tools to the model. The ag-ui tool set rarely changes between
+    turns, so the bound runnable (and its converted tool schemas) is cached per tool set.
+    """
+    def bind() -> Any:
+        return model.bind_tools(
+            [
+                *frontend_tools, # bind tools defined by ag-ui
+                *backend_tools,
+                # your_tool_here
+            ],
+
+            # Allow parallel tool calls; backend tools are read-only, so
+            # tool_node runs them concurrently without ordering concerns.
+            # Frontend actions in the same response are deferred by tool_node.
+            parallel_tool_calls=True,
+        )
+
+    try:
+        key = hashlib.blake2b(orjson.dumps(frontend_tools, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+    except TypeError:
+        # Tool definitions that aren't plain JSON can't be keyed; bind them fresh
+        return bind()
+    model_with_tools = _BOUND_MODEL_CACHE.get(key)
+    if model_with_tools is None:
+        model_with_tools = _BOUND_MODEL_CACHE[key] = bind()
+        if len(_BOUND_MODEL_CACHE) > _BOUND_MODEL_CACHE_SIZE:
+            _BOUND_MODEL_CACHE.popitem(last=False)
+    else:
+        _BOUND_MODEL_CACHE.move_to_end(key)
+    return model_with_tools
+
+# Rolling summaries of chat history that fell out of the prompt window, computed in the
+# background per thread and folded into state on the thread's next turn
+_SUMMARY_MIN_NEW_MESSAGES = 6
+_SUMMARY_PROMPT = (
+    "Summarize this travel-planning conversation in under 150 words. Keep decisions, preferences, "
+    "destinations, dates and open questions; drop pleasantries. Extend the existing summary if one is given."
+)
+_PENDING_SUMMARIES: Dict[str, "asyncio.Task[tuple[str, int]]"] = {}
+_PENDING_SUMMARIES_MAX = 256
+
+async def _summarize_history(model: ChatGoogleGenerativeAI, summary: str, messages: List[Any], upto: int) -> tuple[str, int]:
+    transcript = "\n".join(f"{m.type}: {m.text()}" for m in messages if m.text().strip())
+    if summary:
+        transcript = f"Existing summary: {summary}\n\n{transcript}"
+    result = await model.ainvoke([SystemMessage(content=_SUMMARY_PROMPT), HumanMessage(content=transcript)])
+    return result.text().strip() or summary, upto
+
+def _collect_history_summary(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+    """
+    Return a state update with the thread's finished background summary, if there is one.
+    """
+    thread_id = (config.get("configurable") or {}).get("thread_id")
+    pending = _PENDING_SUMMARIES.get(thread_id)
+    if pending is None or not pending.done():
+        return {}
+    del _PENDING_SUMMARIES[thread_id]
+    if pending.cancelled() or pending.exception() is not None:
+        return {}
+    summary, summarized_upto = pending.result()
+    if summarized_upto <= (state.get("summarized_upto") or 0):
+        return {}
+    return {"summary": summary, "summarized_upto": summarized_upto}
+
+def _schedule_history_summary(
+    model: ChatGoogleGenerativeAI,
+    config: RunnableConfig,
+    summary: str,
+    messages: List[Any],
+    summarized_upto: int,
+    window_start: int,
+) -> None:
+    """
+    Start summarizing messages[summarized_upto:window_start] once enough turns have aged out.
+    """
+    thread_id = (config.get("configurable") or {}).get("thread_id")
+    if not thread_id or thread_id in _PENDING_SUMMARIES or window_start - summarized_upto < _SUMMARY_MIN_NEW_MESSAGES:
+        return
+    if len(_PENDING_SUMMARIES) >= _PENDING_SUMMARIES_MAX:
+        # Drop finished summaries of threads that never came back
+        for stale_id in [tid for tid, task in _PENDING_SUMMARIES.items() if task.done()]:
+            del _PENDING_SUMMARIES[stale_id]
+    # Run in an empty context so the summary call isn't traced or streamed as part of this run
+    _PENDING_SUMMARIES[thread_id] = asyncio.create_task(
+        _summarize_history(model, summary, messages[summarized_upto:window_start], window_start),
+        context=contextvars.Context(),
+    )
+
+# User turns that can be answered from state alone, skipping the model round-trip
+_SHOW_PLAN_RE = _re_user.compile(r"(?i)^\s*(show|display)\s+(me\s+)?(the\s+)?(current\s+)?(itinerary|plan)\s*[.!?]?\s*$")
+_REPEAT_RE = _re_user.compile(r"(?i)^\s*repeat(\s+(that|the|your))?(\s+last)?(\s+(suggestion|answer|message|response))?\s*[.!?]?\s*$")
+
+def _noop_reply(messages: List[Any], content_str: str) -> AIMessage | None:
+    """
+    Return a canned reply when the latest user turn is a recognized no-op command, else None.
+    """
+    if not messages or not isinstance(messages[-1], HumanMessage):
+        return None
+    content = messages[-1].content
+    if not isinstance(content, str) and any(
+        not isinstance(part, str) and part.get("type") != "text" for part in content
+    ):
+        # Turns carrying images, files or other non-text parts always go to the model
+        return None
+    text = messages[-1].text()
+    if not text.strip():
+        return AIMessage(content="What would you like to plan or change? I can research destinations, build itineraries, or add sections to the document.")
+    if _SHOW_PLAN_RE.match(text):
+        if not content_str.strip():
+            return AIMessage(content="The shared document is empty so far. Tell me where you're headed and for how long, and I'll draft an itinerary.")
+        return AIMessage(content=f"Here's the current plan from the shared document:\n\n{content_str}")
+    if _REPEAT_RE.match(text):
+        for message in reversed(messages[:-1]):
+            if isinstance(message, AIMessage) and not message.tool_calls and message.text().strip():
+                return AIMessage(content=message.text())
+    return None
+
+async def chat_node(state: AgentState, config: RunnableConfig) -> Union[Command[Literal["tool_node"]], Dict[str, Any]]:
+    """
+    Standard chat node based on the ReAct design pattern. It handles:
+    - The model to use (and binds in CopilotKit actions and the tools defined above)
+    - The system prompt
+    - Getting a response from the model
+    - Handling tool calls
+
+    For more about the ReAct design pattern, see:
+    https://www.perplexity.ai/search/react-agents-NcXLQhreS0WDzpVaS4m9Cg
+    """
+
+    # 0. Answer deterministic requests (show the plan, repeat, empty input) without an LLM call
+    noop_reply = _noop_reply(state.get("messages") or [], state.get("content") or "")
+    if noop_reply is not None:
+        return {"messages": [noop_reply]}
+
+    # 1. Get the lazily initialized Gemini model (created off the event loop on first use)
+    model = _get_model() if _get_model.cache_info().currsize else await asyncio.to_thread(_get_model)
+
+    # 2. Bind the tools to the model (reused across turns with the same ag-ui tool set)
+    model_with_tools = _bind_tools(model, state.get("tools", []))
+
+    # 3. Define the system message for travel planning and collaboration
+    # Prepare shared group/document context
+    group_id = state.get("group_id") or state.get("groupId") or "Solo planning session"
+    content_str = state.get("content") or ""
+    system_message = _build_system_message(str(group_id), content_str)
 
     # 4. Run the model to generate a response
-    # Limit how much prior chat history we include to reduce stale assumptions
-    prior_messages = list(state.get("messages", []))
-    if len(prior_messages) > 6:
-        prior_messages = prior_messages[-6:]
-
-    response = await model_with_tools.ainvoke([
-        system_message,
-        *prior_messages,
-    ], config)
-
-    # only route to tool node if tool is not in the tools list
-    if route_to_tool_node(response):
+    # Limit how much prior chat history we include to reduce stale assumptions. The current turn
+    # is always sent whole; older turns are bounded by tokens rather than message count.
+    messages = state.get("messages") or []
+    prior_messages = _history_window(messages)
+
+    # Older turns that fell out of the window are folded into a rolling summary. Summaries are
+    # produced in the background and picked up on a later turn, so this turn never waits on them.
+    summary_update = _collect_history_summary(state, config)
+    summary = summary_update.get("summary", state.get("summary") or "")
+    _schedule_history_summary(
+        model,
+        config,
+        summary,
+        messages,
+        summary_update.get("summarized_upto", state.get("summarized_upto") or 0),
+        len(messages) - len(prior_messages),
+    )
+    # Assemble the model input in a single list rather than re-wrapping the history
+    model_input: List[Any] = [system_message]
+    if summary:
+        model_input.append(SystemMessage.model_construct(content=f"Conversation so far: {summary}"))
+    model_input.extend(prior_messages)
+
+    # Stream the completion so final answers reach the frontend token by token; the merged
+    # chunk still carries any tool calls for routing below. Backend tool calls are started as
+    # soon as their arguments are complete, overlapping tool I/O with the rest of the stream.
+    response_chunk = None
+    started_ids: List[str] = []
+    try:
+        async for chunk in model_with_tools.astream(model_input, config):
+            response_chunk = chunk if response_chunk is None else response_chunk + chunk
+            for tool_call in _ready_backend_tool_calls(response_chunk, started_ids):
+                started_ids.append(tool_call["id"])
+                _start_early_tool_run(tool_call, config)
+    except BaseException:
+        for tool_call_id in started_ids:
+            early_run = _EARLY_TOOL_RUNS.pop(tool_call_id, None)
+            if early_run is not None:
+                early_run.cancel()
+        raise
+    response = message_chunk_to_message(response_chunk) if response_chunk is not None else AIMessage(content="")
+
+    # only route to tool node if a tool call targets a backend tool (frontend actions are left to the client)
+    tool_calls = getattr(response, "tool_calls", None)
+    if tool_calls and any(tool_call.get("name") in backend_tool_names for tool_call in tool_calls):
         print("routing to tool node")
         return Command(
             goto="tool_node",
             update={
                 "messages": [response],
+                **summary_update,
             }
         )
 
-    # 5. We've handled all tool calls, so we can end the graph.
-    return Command(
-        goto=END,
-        update={
-            "messages": [response],
-        }
+    # 5. We've handled all tool calls; a plain state update ends the graph since
+    #    chat_node has no outgoing edges of its own.
+    return {"messages": [response], **summary_update}
+
+_backend_tools_by_name = {tool.name: tool for tool in backend_tools}
+
+# Backend tool runs started by chat_node while the model was still streaming, keyed by
+# tool_call id; tool_node awaits these instead of invoking the tool a second time.
+_EARLY_TOOL_RUNS: Dict[str, "asyncio.Task[ToolMessage]"] = {}
+# How long a finished early run waits for tool_node before it is dropped (e.g., the run was
+# cancelled or interrupted after chat_node returned)
+_EARLY_TOOL_RUN_TTL_SECONDS = 60
+
+def _start_early_tool_run(tool_call: Dict[str, Any], config: RunnableConfig) -> None:
+    tool_call_id = tool_call["id"]
+    task = _EARLY_TOOL_RUNS[tool_call_id] = asyncio.create_task(_invoke_backend_tool(tool_call, config))
+    task.add_done_callback(
+        lambda done: done.get_loop().call_later(_EARLY_TOOL_RUN_TTL_SECONDS, _expire_early_tool_run, tool_call_id, done)
     )
 
-def route_to_tool_node(response: BaseMessage):
+def _expire_early_tool_run(tool_call_id: str, task: "asyncio.Task[ToolMessage]") -> None:
+    if _EARLY_TOOL_RUNS.get(tool_call_id) is task:
+        del _EARLY_TOOL_RUNS[tool_call_id]
+    if not task.cancelled():
+        task.exception()  # mark a failure as retrieved so it isn't logged as never retrieved
+
+def _ready_backend_tool_calls(response_chunk: Any, started_ids: List[str]) -> List[Dict[str, Any]]:
     """
-    Route to tool node if any tool call in the response matches a backend tool name.
+    Backend tool calls in a partially streamed response whose arguments already parse as
+    complete JSON and that have not been started yet.
     """
-    tool_calls = getattr(response, "tool_calls", None)
-    if not tool_calls:
-        return False
+    ready: List[Dict[str, Any]] = []
+    for tool_call_chunk in getattr(response_chunk, "tool_call_chunks", None) or ():
+        tool_call_id = tool_call_chunk.get("id")
+        if not tool_call_id or tool_call_id in started_ids or tool_call_chunk.get("name") not in backend_tool_names:
+            continue
+        try:
+            args = orjson.loads(tool_call_chunk.get("args") or "")
+        except orjson.JSONDecodeError:
+            continue
+        if isinstance(args, dict):
+            ready.append({"name": tool_call_chunk["name"], "args": args, "id": tool_call_id, "type": "tool_call"})
+    return ready
+
+async def _invoke_backend_tool(tool_call: Dict[str, Any], config: RunnableConfig) -> ToolMessage:
+    return await _backend_tools_by_name[tool_call["name"]].ainvoke({**tool_call, "type": "tool_call"}, config)
+
+async def _run_backend_tool(tool_call: Dict[str, Any], config: RunnableConfig) -> ToolMessage:
+    if tool_call.get("name") not in backend_tool_names:
+        # A frontend action that came in the same response as backend calls. The client only
+        # runs actions once the graph ends, so ask the model to repeat it after the results.
+        return ToolMessage(
+            content=(
+                f"{tool_call['name']} was not executed yet because it was requested together with "
+                "backend tools. Call it again after reading the tool results."
+            ),
+            name=tool_call["name"],
+            tool_call_id=tool_call["id"],
+        )
+    early_run = _EARLY_TOOL_RUNS.pop(tool_call.get("id"), None)
+    try:
+        if early_run is not None:
+            return await early_run
+        return await _invoke_backend_tool(tool_call, config)
+    except Exception as e:
+        return ToolMessage(
+            content=f"Error: {e!r}\n Please fix your mistakes.",
+            name=tool_call["name"],
+            tool_call_id=tool_call["id"],
+            status="error",
+        )
 
-    for tool_call in tool_calls:
-        if tool_call.get("name") in backend_tool_names:
-            return True
-    return False
+async def tool_node(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+    """
+    Run every backend tool call from the last model response concurrently.
+    Backend tools are read-only, so calls have no ordering constraints between them.
+    Every call gets a ToolMessage, as the model API rejects unanswered calls. A frontend
+    action mixed into the same response (e.g., updateDocument next to
+    create_itinerary_template) is answered with a "not executed yet" note so the model
+    issues it again, on its own, once it has the backend results.
+    """
+    tool_calls = getattr(state["messages"][-1], "tool_calls", None) or []
+    results = await asyncio.gather(*(
+        _run_backend_tool(tool_call, config) for tool_call in tool_calls
+    ))
+    return {"messages": list(results)}
 
 # Define the workflow graph
 workflow = StateGraph(AgentState)
 workflow.add_node("chat_node", chat_node)
-workflow.add_node("tool_node", ToolNode(tools=backend_tools))
+workflow.add_node("tool_node", tool_node)
 workflow.add_edge("tool_node", "chat_node")
 workflow.set_entry_point("chat_node")
 
 graph = workflow.compile()
+
+async def fast_state(config: RunnableConfig, checkpointer: Any = None) -> List[Any]:
+    """
+    Read just the message list for a thread straight from the checkpointer.
+    Much cheaper than graph.aget_state(config), which assembles a full StateSnapshot; use it
+    on hot paths that only need messages and keep aget_state for full introspection.
+    Pass the checkpointer explicitly when the graph was compiled without one (e.g., when the
+    LangGraph server attaches its own at runtime).
+    """
+    checkpointer = checkpointer or graph.checkpointer
+    if checkpointer is None:
+        raise ValueError("No checkpointer set")
+    checkpoint_tuple = await checkpointer.aget_tuple(config)
+    if checkpoint_tuple is None:
+        return []
+    return checkpoint_tuple.checkpoint["channel_values"].get("messages", [])